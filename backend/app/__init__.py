@@ -2,11 +2,30 @@ import logging
 from urllib.parse import urlparse
 
 from celery import Celery, Task
-from flask import Flask, jsonify, request
-from flask_cors import CORS
+from celery.signals import worker_process_init
+from flask import Flask, has_app_context, jsonify, request
 
 logger = logging.getLogger(__name__)
 
+# The API is public and JSON-only, so every response gets the same CORS headers.
+# Preflight OPTIONS requests are answered by Flask's automatic OPTIONS handling.
+_CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+}
+
+# The Flask app whose context Celery worker processes push; set by _init_celery().
+_worker_app: Flask | None = None
+
+
+@worker_process_init.connect
+def _push_worker_app_context(**kwargs):
+    # One app context for the life of each worker process, never popped, so
+    # tasks don't pay for a context push/pop and teardown on every call.
+    if _worker_app is not None:
+        _worker_app.app_context().push()
+
 
 def create_app() -> Flask:
     logging.basicConfig(
@@ -18,7 +37,10 @@ def create_app() -> Flask:
     app = Flask(__name__)
     app.config.from_object("app.config.Config")
 
-    CORS(app)
+    @app.after_request
+    def add_cors_headers(response):
+        response.headers.update(_CORS_HEADERS)
+        return response
 
     _init_celery(app)
 
@@ -30,6 +52,9 @@ def create_app() -> Flask:
 
     @app.after_request
     def log_request(response):
+        # Health checks are polled constantly; don't log them
+        if request.path == "/health":
+            return response
         logger.info("%s %s %s", request.method, request.path, response.status_code)
         return response
 
@@ -42,8 +67,19 @@ def create_app() -> Flask:
 
 
 def _init_celery(app: Flask) -> Celery:
+    from app.db import close_db
+
     class FlaskTask(Task):
         def __call__(self, *args, **kwargs):
+            # Worker processes already hold a long-lived context (pushed by
+            # _push_worker_app_context); only push one per call when they don't.
+            if has_app_context():
+                try:
+                    return self.run(*args, **kwargs)
+                finally:
+                    # The long-lived context is never torn down, so hand the
+                    # task's DB connection back to the pool here
+                    close_db()
             with app.app_context():
                 return self.run(*args, **kwargs)
 
@@ -56,6 +92,9 @@ def _init_celery(app: Flask) -> Celery:
     celery_app.set_default()
     app.extensions["celery"] = celery_app
 
+    global _worker_app
+    _worker_app = app
+
     parsed = urlparse(app.config["REDIS_URL"])
     logger.info("Celery initialized with broker %s://%s", parsed.scheme, parsed.hostname)
     return celery_app
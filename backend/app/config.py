@@ -6,3 +6,8 @@ class Config:
     AMADEUS_CLIENT_SECRET = os.environ["AMADEUS_CLIENT_SECRET"]
     SUPABASE_DB_URL = os.environ["SUPABASE_DB_URL"]
     REDIS_URL = os.environ["REDIS_URL"]
+    # Concurrent Amadeus calls per job. Self-Service allows 10 TPS (test) / 40 (production).
+    AMADEUS_MAX_CONCURRENCY = int(os.environ.get("AMADEUS_MAX_CONCURRENCY") or 8)
+    # Server-side prepared statements. Set to "false" when SUPABASE_DB_URL points at a
+    # transaction-mode pooler (Supavisor/pgbouncer, port 6543), which can't hold them.
+    DB_PREPARED_STATEMENTS = os.environ.get("DB_PREPARED_STATEMENTS", "true").lower() != "false"
@@ -1,14 +1,64 @@
-import psycopg2
+import json
+import threading
+
+import orjson
 from flask import current_app, g
+from psycopg.types.json import set_json_dumps, set_json_loads
+from psycopg_pool import ConnectionPool
+
+
+def _json_dumps(obj) -> bytes | str:
+    try:
+        return orjson.dumps(obj)
+    except TypeError:
+        # orjson rejects some values json accepts, e.g. integers beyond 64 bits
+        return json.dumps(obj)
+
+
+# Serialize Json/Jsonb parameters and parse jsonb results with orjson; the
+# job result payload is the largest thing we write.
+set_json_dumps(_json_dumps)
+set_json_loads(orjson.loads)
+
+# One pool per process, created on first use — never before a Celery fork.
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Autocommit: every write here is a single statement, so each is its
+            # own transaction and no extra BEGIN/COMMIT round trips are needed
+            connect_kwargs = {"autocommit": True}
+            if not current_app.config["DB_PREPARED_STATEMENTS"]:
+                # Stop psycopg from preparing repeated statements on its own
+                connect_kwargs["prepare_threshold"] = None
+            _pool = ConnectionPool(
+                current_app.config["SUPABASE_DB_URL"],
+                min_size=1,
+                max_size=10,
+                kwargs=connect_kwargs,
+                # Replace connections the server or a pooler dropped while idle
+                check=ConnectionPool.check_connection,
+                open=True,
+            )
+    return _pool
+
+
+def prepare_statements() -> bool:
+    """Value for execute(prepare=...) on hot queries; False when prepared statements are disabled."""
+    return current_app.config["DB_PREPARED_STATEMENTS"]
 
 
 def get_db():
     if "db" not in g:
-        g.db = psycopg2.connect(current_app.config["SUPABASE_DB_URL"])
+        g.db = _get_pool().getconn()
     return g.db
 
 
 def close_db(e=None):
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        _get_pool().putconn(db)
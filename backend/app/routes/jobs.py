@@ -1,49 +1,55 @@
-import json
 import logging
 import uuid
 
+import fastjsonschema
+from fastjsonschema import JsonSchemaValueException
 from flask import Blueprint, jsonify, request
+from psycopg.types.json import Jsonb
 
-from app.db import get_db
+from app.db import get_db, prepare_statements
 from app.tasks import run_flock_job
 
 bp = Blueprint("jobs", __name__)
 logger = logging.getLogger(__name__)
 
-_TIME_WINDOW_FIELDS = (
-    "outbound_departure_window",
-    "outbound_arrival_window",
-    "return_departure_window",
-    "return_arrival_window",
-)
-
-
-def _validate_filters(f: dict, path: str) -> None:
-    if not isinstance(f.get("non_stop_only"), bool):
-        raise ValueError(f"{path}.non_stop_only must be a boolean")
-    if not isinstance(f.get("excluded_airlines"), list):
-        raise ValueError(f"{path}.excluded_airlines must be a list")
-    for field in _TIME_WINDOW_FIELDS:
-        window = f.get(field)
-        if window is not None:
-            if not isinstance(window, dict) or "earliest" not in window or "latest" not in window:
-                raise ValueError(f"{path}.{field} must have 'earliest' and 'latest' fields")
-
-
-def _validate_submission(data: dict) -> None:
-    for field in ("travelers", "destinations", "outbound_date", "return_date", "default_filters"):
-        if field not in data:
-            raise ValueError(f"Missing required field: {field}")
-    if not isinstance(data["travelers"], list) or len(data["travelers"]) == 0:
-        raise ValueError("travelers must be a non-empty list")
-    if not isinstance(data["destinations"], list) or len(data["destinations"]) == 0:
-        raise ValueError("destinations must be a non-empty list")
-    for i, traveler in enumerate(data["travelers"]):
-        for field in ("name", "origin_airport", "filters"):
-            if field not in traveler:
-                raise ValueError(f"travelers[{i}] missing field: {field}")
-        _validate_filters(traveler["filters"], f"travelers[{i}].filters")
-    _validate_filters(data["default_filters"], "default_filters")
+_TIME_WINDOW = {
+    "type": ["object", "null"],
+    "required": ["earliest", "latest"],
+}
+
+_FILTERS = {
+    "type": "object",
+    "required": ["non_stop_only", "excluded_airlines"],
+    "properties": {
+        "non_stop_only": {"type": "boolean"},
+        "excluded_airlines": {"type": "array"},
+        "outbound_departure_window": _TIME_WINDOW,
+        "outbound_arrival_window": _TIME_WINDOW,
+        "return_departure_window": _TIME_WINDOW,
+        "return_arrival_window": _TIME_WINDOW,
+    },
+}
+
+_SUBMISSION_SCHEMA = {
+    "type": "object",
+    "required": ["travelers", "destinations", "outbound_date", "return_date", "default_filters"],
+    "properties": {
+        "travelers": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "required": ["name", "origin_airport", "filters"],
+                "properties": {"filters": _FILTERS},
+            },
+        },
+        "destinations": {"type": "array", "minItems": 1},
+        "default_filters": _FILTERS,
+    },
+}
+
+# Compiled once at import; raises JsonSchemaValueException on invalid input.
+_validate_submission = fastjsonschema.compile(_SUBMISSION_SCHEMA)
 
 
 @bp.post("/jobs")
@@ -54,9 +60,9 @@ def create_job():
 
     try:
         _validate_submission(data)
-    except ValueError as e:
-        logger.warning("Validation failed: %s", e)
-        return jsonify({"error": str(e)}), 400
+    except JsonSchemaValueException as e:
+        logger.warning("Validation failed: %s", e.message)
+        return jsonify({"error": e.message}), 400
 
     travelers = data["travelers"]
     destinations = data["destinations"]
@@ -68,20 +74,21 @@ def create_job():
         data.get("return_date"),
     )
 
-    job_id = str(uuid.uuid4())
+    # Passed to psycopg as a UUID so it goes over the wire as a native uuid
+    job_id = uuid.uuid4()
     db = get_db()
-    with db:
-        with db.cursor() as cur:
-            cur.execute(
-                "insert into jobs (id, status, submission) values (%s, 'pending', %s)",
-                (job_id, json.dumps(data)),
-            )
+    with db.cursor() as cur:
+        cur.execute(
+            "insert into jobs (id, status, submission) values (%s, 'pending', %s)",
+            (job_id, Jsonb(data)),
+            prepare=prepare_statements(),
+        )
     logger.info("Job %s written to database with status=pending", job_id)
 
-    run_flock_job.delay(job_id)
+    run_flock_job.delay(str(job_id))
     logger.info("Job %s enqueued", job_id)
 
-    return jsonify({"job_id": job_id}), 201
+    return jsonify({"job_id": str(job_id)}), 201
 
 
 @bp.get("/jobs/<job_id>")
@@ -91,6 +98,7 @@ def get_job(job_id: str):
         cur.execute(
             "select id, status, created_at, completed_at, error from jobs where id = %s",
             (job_id,),
+            prepare=prepare_statements(),
         )
         row = cur.fetchone()
 
@@ -109,7 +117,7 @@ def get_job(job_id: str):
 
     if status == "complete":
         with db.cursor() as cur:
-            cur.execute("select data from results where job_id = %s", (job_id,))
+            cur.execute("select data from results where job_id = %s", (job_id,), prepare=prepare_statements())
             result_row = cur.fetchone()
         if result_row:
             response["result"] = result_row[0]
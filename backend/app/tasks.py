@@ -1,16 +1,43 @@
-import json
 import logging
-import re
-import statistics
+import random
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import itemgetter
 
 from amadeus import Client, ResponseError
+from amadeus.client.access_token import AccessToken
+from amadeus.client.errors import ServerError
 from celery import shared_task
 from flask import current_app
+from psycopg.types.json import Jsonb
 
-from app.db import get_db
+from app.db import get_db, prepare_statements
 
 logger = logging.getLogger(__name__)
 
+# Rate-limited (429) and 5xx Amadeus calls are retried with exponential backoff.
+_AMADEUS_RETRIES = 3
+_AMADEUS_BACKOFF_SECONDS = 1.0
+
+# segment → ("AA", "100"); joined into a flight number like "AA100"
+_FLIGHT_NUMBER_PARTS = itemgetter("carrierCode", "number")
+
+# (filter field, itinerary index, segment index, segment end) for each time window
+_TIME_WINDOW_CHECKS = (
+    ("outbound_departure_window", 0, 0, "departure"),
+    ("outbound_arrival_window", 0, -1, "arrival"),
+    ("return_departure_window", 1, 0, "departure"),
+    ("return_arrival_window", 1, -1, "arrival"),
+)
+
+# IATA code → city name. Effectively static, so kept for the life of the worker.
+# Failed lookups are not cached so they are retried on the next job.
+_DEST_NAME_CACHE: dict[str, str] = {}
+
+# Per-process Amadeus client, created lazily by _get_amadeus().
+_amadeus: Client | None = None
+
 
 # ---------------------------------------------------------------------------
 # Helpers
@@ -18,40 +45,46 @@ logger = logging.getLogger(__name__)
 
 def _parse_duration_minutes(duration: str) -> int:
     """Convert an ISO 8601 duration string (e.g. 'PT10H30M') to minutes."""
-    hours = int(re.search(r"(\d+)H", duration).group(1)) if "H" in duration else 0
-    mins = int(re.search(r"(\d+)M", duration).group(1)) if "M" in duration else 0
+    hours = mins = n = 0
+    for c in duration:  # single pass; called once per itinerary
+        if c.isdigit():
+            n = n * 10 + ord(c) - 48
+        elif c == "H":
+            hours, n = n, 0
+        elif c == "M":
+            mins, n = n, 0
+        else:
+            n = 0
     return hours * 60 + mins
 
 
-def _in_time_window(dt_str: str, window: dict | None) -> bool:
-    """Return True if the HH:MM portion of dt_str falls within window."""
-    if window is None:
+def _compile_filter(filters: dict) -> Callable[[dict], bool]:
+    """Build a predicate that returns True if an offer satisfies all post-response filters.
+
+    Unset time windows are dropped here, so the returned function only runs the
+    checks that apply to this traveler.
+    """
+    max_segments = filters["max_stops"] + 1
+    windows = tuple(
+        (itinerary, segment, end, window["earliest"], window["latest"])
+        for field, itinerary, segment, end in _TIME_WINDOW_CHECKS
+        if (window := filters.get(field)) is not None
+    )
+
+    def passes(offer: dict) -> bool:
+        itineraries = offer["itineraries"]
+        if len(itineraries[0]["segments"]) > max_segments:
+            return False
+        if len(itineraries[1]["segments"]) > max_segments:
+            return False
+        for itinerary, segment, end, earliest, latest in windows:
+            # "2024-11-01T10:40:00" → "10:40"
+            time_part = itineraries[itinerary]["segments"][segment][end]["at"].partition("T")[2][:5]
+            if not earliest <= time_part <= latest:
+                return False
         return True
-    time_part = dt_str.split("T")[1][:5]  # "2024-11-01T10:40:00" → "10:40"
-    return window["earliest"] <= time_part <= window["latest"]
-
-
-def _passes_filters(offer: dict, filters: dict) -> bool:
-    """Return True if the offer satisfies all post-response filters."""
-    itineraries = offer["itineraries"]
-    outbound_segs = itineraries[0]["segments"]
-    return_segs = itineraries[1]["segments"]
 
-    if len(outbound_segs) - 1 > filters["max_stops"]:
-        return False
-    if len(return_segs) - 1 > filters["max_stops"]:
-        return False
-
-    if not _in_time_window(outbound_segs[0]["departure"]["at"], filters.get("outbound_departure_window")):
-        return False
-    if not _in_time_window(outbound_segs[-1]["arrival"]["at"], filters.get("outbound_arrival_window")):
-        return False
-    if not _in_time_window(return_segs[0]["departure"]["at"], filters.get("return_departure_window")):
-        return False
-    if not _in_time_window(return_segs[-1]["arrival"]["at"], filters.get("return_arrival_window")):
-        return False
-
-    return True
+    return passes
 
 
 def _build_flight_option(itinerary: dict, price: float) -> dict:
@@ -62,34 +95,126 @@ def _build_flight_option(itinerary: dict, price: float) -> dict:
         "duration_minutes": _parse_duration_minutes(itinerary["duration"]),
         "stops": len(segments) - 1,
         "airline": segments[0]["carrierCode"],
-        "flight_numbers": [seg["carrierCode"] + seg["number"] for seg in segments],
+        "flight_numbers": list(map("".join, map(_FLIGHT_NUMBER_PARTS, segments))),
         "price": price,
     }
 
 
 def _compute_group_stats(individual_totals: list, currency: str) -> dict:
+    # One sort gives median, cheapest and most expensive
+    ordered = sorted(individual_totals)
+    n = len(ordered)
+    mid = n // 2
+    median = ordered[mid] if n % 2 else (ordered[mid - 1] + ordered[mid]) / 2
     total = sum(individual_totals)
     return {
         "currency": currency,
         "individual_totals": individual_totals,
         "total": total,
-        "average": total / len(individual_totals),
-        "median": statistics.median(individual_totals),
-        "cheapest": min(individual_totals),
-        "most_expensive": max(individual_totals),
+        "average": total / n,
+        "median": median,
+        "cheapest": ordered[0],
+        "most_expensive": ordered[-1],
     }
 
 
+def _best_traveler_flight(
+    job_id: str, traveler: dict, destination: str, offers: list, passes: Callable[[dict], bool]
+) -> dict | None:
+    """Pick the cheapest offer accepted by passes, or None if none are."""
+    origin = traveler["origin_airport"]
+
+    # Single pass: filter and track the cheapest offer without building a list
+    best, total_price, n_valid = None, float("inf"), 0
+    for offer in offers:
+        if not passes(offer):
+            continue
+        n_valid += 1
+        price = float(offer["price"]["total"])
+        if price < total_price:
+            best, total_price = offer, price
+
+    logger.info(
+        "[%s] %s -> %s: %d offer(s) returned, %d after filtering",
+        job_id, origin, destination, len(offers), n_valid,
+    )
+    if best is None:
+        return None
+
+    currency = best["price"]["currency"]
+    leg_price = total_price / 2
+
+    return {
+        "traveler_name": traveler["name"],
+        "origin": origin,
+        "outbound": _build_flight_option(best["itineraries"][0], leg_price),
+        "return": _build_flight_option(best["itineraries"][1], leg_price),
+        "total_price": total_price,
+        "currency": currency,
+    }
+
+
+def _is_retryable(error: ResponseError) -> bool:
+    return isinstance(error, ServerError) or getattr(error.response, "status_code", None) == 429
+
+
+def _call_amadeus(method: Callable, **params):
+    """Call an Amadeus endpoint, retrying rate-limit and server errors with backoff."""
+    for attempt in range(_AMADEUS_RETRIES + 1):
+        try:
+            return method(**params)
+        except ResponseError as e:
+            if not _is_retryable(e) or attempt == _AMADEUS_RETRIES:
+                raise
+            # Jittered so workers rate-limited together don't retry in lockstep
+            delay = _AMADEUS_BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning(
+                "Amadeus returned %s, retrying in %.1fs", getattr(e.response, "status_code", None), delay,
+            )
+            time.sleep(delay)
+
+
+def _ensure_access_token(client: Client) -> None:
+    """Fetch or refresh the client's OAuth token on the calling thread.
+
+    The SDK's AccessToken has no lock, so without this every pool thread would
+    request its own token on a cold worker or after expiry.
+    """
+    if not hasattr(client, "access_token"):
+        client.access_token = AccessToken(client)  # same memo attribute the SDK uses
+    client.access_token._bearer_token()
+
+
 def _get_destination_name(client: Client, iata_code: str) -> str:
+    """Resolve an IATA code to its city name, cached per worker process."""
+    cached = _DEST_NAME_CACHE.get(iata_code)
+    if cached is not None:
+        return cached
     try:
-        response = client.reference_data.locations.get(keyword=iata_code, subType="AIRPORT")
+        response = _call_amadeus(client.reference_data.locations.get, keyword=iata_code, subType="AIRPORT")
         if response.data:
-            return response.data[0].get("address", {}).get("cityName", iata_code)
+            name = response.data[0].get("address", {}).get("cityName", iata_code)
+            _DEST_NAME_CACHE[iata_code] = name
+            return name
     except Exception:
         logger.warning("Could not resolve city name for %s, using IATA code", iata_code)
     return iata_code
 
 
+def _get_amadeus() -> Client:
+    """Return this worker process's Amadeus client, creating it on first use.
+
+    Reusing the client lets its OAuth token carry over between jobs.
+    """
+    global _amadeus
+    if _amadeus is None:
+        _amadeus = Client(
+            client_id=current_app.config["AMADEUS_CLIENT_ID"],
+            client_secret=current_app.config["AMADEUS_CLIENT_SECRET"],
+        )
+    return _amadeus
+
+
 # ---------------------------------------------------------------------------
 # Task
 # ---------------------------------------------------------------------------
@@ -100,46 +225,37 @@ def run_flock_job(job_id: str) -> None:
     db = get_db()
 
     try:
-        # Fetch submission
+        # Mark running and fetch the submission in the same statement
         with db.cursor() as cur:
-            cur.execute("select submission from jobs where id = %s", (job_id,))
+            cur.execute(
+                "update jobs set status = 'running' where id = %s returning submission",
+                (job_id,),
+                prepare=prepare_statements(),
+            )
             row = cur.fetchone()
         if row is None:
             raise ValueError(f"Job {job_id} not found in database")
         submission = row[0]
-
-        # Mark running
-        with db:
-            with db.cursor() as cur:
-                cur.execute("update jobs set status = 'running' where id = %s", (job_id,))
         logger.info("[%s] Status set to running", job_id)
 
-        # Init Amadeus client
-        amadeus = Client(
-            client_id=current_app.config["AMADEUS_CLIENT_ID"],
-            client_secret=current_app.config["AMADEUS_CLIENT_SECRET"],
-        )
+        amadeus = _get_amadeus()
 
         travelers = submission["travelers"]
         destinations = submission["destinations"]
         outbound_date = submission["outbound_date"]
         return_date = submission["return_date"]
 
-        # Resolve destination city names
-        dest_names = {dest: _get_destination_name(amadeus, dest) for dest in destinations}
-
-        # Fan out: traveler × destination
-        results_by_dest: dict[str, list] = {}
-
-        for traveler in travelers:
-            name = traveler["name"]
-            origin = traveler["origin_airport"]
+        # Fan out: traveler × destination. Travelers sharing an origin and the
+        # query-time filters produce identical searches, so each distinct query
+        # is sent once and its offers are filtered per traveler afterwards.
+        searches: dict[tuple, tuple[dict, list[tuple[int, str]]]] = {}
+        for i, traveler in enumerate(travelers):
             filters = traveler["filters"]
             excluded = filters.get("excluded_airlines", [])
 
             for destination in destinations:
                 call_kwargs = {
-                    "originLocationCode": origin,
+                    "originLocationCode": traveler["origin_airport"],
                     "destinationLocationCode": destination,
                     "departureDate": outbound_date,
                     "returnDate": return_date,
@@ -147,37 +263,52 @@ def run_flock_job(job_id: str) -> None:
                     "nonStop": filters["non_stop_only"],
                 }
                 if excluded:
-                    call_kwargs["excludedAirlineCodes"] = ",".join(excluded)
-
+                    call_kwargs["excludedAirlineCodes"] = ",".join(sorted(excluded))
+                key = tuple(sorted(call_kwargs.items()))
+                searches.setdefault(key, (call_kwargs, []))[1].append((i, destination))
+
+        offer_filters = [_compile_filter(traveler["filters"]) for traveler in travelers]
+        flights: dict[tuple[int, str], dict] = {}
+        _ensure_access_token(amadeus)
+        max_workers = min(current_app.config["AMADEUS_MAX_CONCURRENCY"], len(searches) + len(destinations))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # Resolve destination city names alongside the flight searches
+            name_futures = {dest: pool.submit(_get_destination_name, amadeus, dest) for dest in destinations}
+            futures = {
+                pool.submit(_call_amadeus, amadeus.shopping.flight_offers_search.get, **call_kwargs): requesters
+                for call_kwargs, requesters in searches.values()
+            }
+            for future in as_completed(futures):
+                requesters = futures[future]
+                _, destination = requesters[0]
+                origin = travelers[requesters[0][0]]["origin_airport"]
                 try:
-                    response = amadeus.shopping.flight_offers_search.get(**call_kwargs)
+                    response = future.result()
                     logger.info("[%s] Amadeus call: %s -> %s on %s", job_id, origin, destination, outbound_date)
                 except ResponseError as e:
+                    if _is_retryable(e):
+                        # Out of retries; fail the job rather than silently drop the
+                        # destination, without sending the searches still queued
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        raise
                     logger.warning("[%s] Amadeus error for %s -> %s: %s", job_id, origin, destination, e)
                     continue
 
-                valid = [o for o in response.data if _passes_filters(o, filters)]
-                logger.info(
-                    "[%s] %s -> %s: %d offer(s) returned, %d after filtering",
-                    job_id, origin, destination, len(response.data), len(valid),
-                )
-                if not valid:
-                    continue
+                for i, destination in requesters:
+                    traveler_flight = _best_traveler_flight(
+                        job_id, travelers[i], destination, response.data, offer_filters[i],
+                    )
+                    if traveler_flight is not None:
+                        flights[(i, destination)] = traveler_flight
 
-                best = min(valid, key=lambda o: float(o["price"]["total"]))
-                total_price = float(best["price"]["total"])
-                currency = best["price"]["currency"]
-                leg_price = total_price / 2
-
-                traveler_flight = {
-                    "traveler_name": name,
-                    "origin": origin,
-                    "outbound": _build_flight_option(best["itineraries"][0], leg_price),
-                    "return": _build_flight_option(best["itineraries"][1], leg_price),
-                    "total_price": total_price,
-                    "currency": currency,
-                }
-                results_by_dest.setdefault(destination, []).append(traveler_flight)
+            dest_names = {dest: future.result() for dest, future in name_futures.items()}
+
+        # Collect in submission order so results don't depend on completion order
+        results_by_dest: dict[str, list] = {}
+        for i in range(len(travelers)):
+            for destination in destinations:
+                if (i, destination) in flights:
+                    results_by_dest.setdefault(destination, []).append(flights[(i, destination)])
 
         # Aggregate — only include destinations where every traveler has a flight
         destination_results = []
@@ -210,17 +341,20 @@ def run_flock_job(job_id: str) -> None:
             "destinations": destination_results,
         }
 
-        # Write results and mark complete
-        with db:
-            with db.cursor() as cur:
-                cur.execute(
-                    "insert into results (job_id, data) values (%s, %s)",
-                    (job_id, json.dumps(job_result)),
-                )
-                cur.execute(
-                    "update jobs set status = 'complete', completed_at = now() where id = %s",
-                    (job_id,),
+        # Write results and mark complete in a single round trip
+        with db.cursor() as cur:
+            cur.execute(
+                """
+                with r as (
+                    insert into results (job_id, data) values (%s, %s)
+                    returning job_id
                 )
+                update jobs set status = 'complete', completed_at = now()
+                where id = (select job_id from r)
+                """,
+                (job_id, Jsonb(job_result)),
+                prepare=prepare_statements(),
+            )
 
         logger.info("[%s] Job complete — %d destination(s)", job_id, len(destination_results))
 
@@ -229,12 +363,11 @@ def run_flock_job(job_id: str) -> None:
         try:
             import traceback
             error_msg = traceback.format_exc()
-            with db:
-                with db.cursor() as cur:
-                    cur.execute(
-                        "update jobs set status = 'failed', error = %s where id = %s",
-                        (error_msg, job_id),
-                    )
+            with db.cursor() as cur:
+                cur.execute(
+                    "update jobs set status = 'failed', error = %s where id = %s",
+                    (error_msg, job_id),
+                )
         except Exception:
             logger.exception("[%s] Failed to write failure status to DB", job_id)
         raise